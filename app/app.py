@@ -1,10 +1,15 @@
 import os
-import json
+import atexit
 import datetime
-import pickle
+import hashlib
+import queue
 import tempfile
+import threading
 
+import msgspec
+import zstandard as zstd
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from dotenv import load_dotenv
 from openai import AzureOpenAI, OpenAI
 from streamlit_shortcuts import add_shortcuts
@@ -12,29 +17,66 @@ from streamlit_shortcuts import add_shortcuts
 import prompts
 
 
+# msgpack encoder/decoder for session persistence (much faster than pickle,
+# and doesn't execute arbitrary code on load)
+_ENCODER = msgspec.msgpack.Encoder()
+_DECODER = msgspec.msgpack.Decoder()
+
+# Frames are zstd-compressed before hitting disk; level 3 is near free on
+# encode and chat prose compresses well, so writes and fsyncs shrink too
+_ZSTD_C = zstd.ZstdCompressor(level=3)
+_ZSTD_D = zstd.ZstdDecompressor()
+
+
+def _encode_frame(message):
+    """Encode one message as a length-prefixed, compressed log frame"""
+    data = _ZSTD_C.compress(_ENCODER.encode(message))
+    return len(data).to_bytes(4, 'big') + data
+
+# Bounds on the on-disk session footprint
+_SESSION_TTL_SECONDS = 24 * 60 * 60   # stale files older than this are removed
+_MAX_SESSION_BYTES = 5 * 1024 * 1024  # oversized files are trimmed to...
+_TRUNCATE_KEEP_FRAMES = 200           # ...the most recent frames
+
+
+# Per-deployment configuration: anything a sibling variant of this app would
+# change lives here, so the rest of the script stays deployment-agnostic
+PAGE_TITLE = "GPT-Reed"
+PAGE_ICON = "🤖"
+DEFAULT_MODEL = "GPT 5"
+USER_AVATAR = ":material/account_circle:"
+ASSISTANT_AVATAR = ":material/auto_awesome:"
+
 # Configure page
 st.set_page_config(
-    page_title="GPT-Reed",
-    page_icon="🤖",
+    page_title=PAGE_TITLE,
+    page_icon=PAGE_ICON,
     initial_sidebar_state="auto"
 )
 
-# Available models
-AVAILABLE_MODELS = {
-    # "Auto": "model-router",
-    "o4 mini": "o4-mini",
-    "GPT 5": "gpt-5-chat",
-    "GPT 4.1": "gpt-4.1",
-    "GPT 4o": "gpt-4o",
-    # "GPT 4": "gpt-4",
-    "GPT OSS": "gpt-oss-120b",
-    # "GPT Nano": "gpt-4.1-nano",
-    # "GPT 3.5": "gpt-35-turbo",
-}
+# Available models, built once per process (the script body re-executes on
+# every rerun, so module-level literals are otherwise rebuilt each time)
+@st.cache_resource
+def _get_available_models():
+    return {
+        # "Auto": "model-router",
+        "o4 mini": "o4-mini",
+        "GPT 5": "gpt-5-chat",
+        "GPT 4.1": "gpt-4.1",
+        "GPT 4o": "gpt-4o",
+        # "GPT 4": "gpt-4",
+        "GPT OSS": "gpt-oss-120b",
+        # "GPT Nano": "gpt-4.1-nano",
+        # "GPT 3.5": "gpt-35-turbo",
+    }
+
+AVAILABLE_MODELS = _get_available_models()
+_MODEL_KEYS = list(AVAILABLE_MODELS.keys())
+_MODEL_KEY_INDEX = {k: i for i, k in enumerate(_MODEL_KEYS)}
 
 # Initialize model selection in session state
 if "selected_model" not in st.session_state:
-    st.session_state.selected_model = "GPT 5"
+    st.session_state.selected_model = DEFAULT_MODEL
 
 
 # Session persistence functions
@@ -42,21 +84,130 @@ def get_session_file_path():
     """Get the path for the session persistence file"""
     temp_dir = tempfile.gettempdir()
 
-    # Use a more stable session ID based on Streamlit's session info
+    # Key the file on Streamlit's own session id, which is stable across
+    # reruns for a given browser tab (unlike id(), which can collide
+    # across process restarts and leave orphan files behind). blake2b
+    # normalizes it to a fixed-length, filename-safe 128-bit digest.
     if 'session_id' not in st.session_state:
-        # Create a persistent session ID that survives page refreshes
-        session_hash = hash(str(id(st.session_state))) % 1000000
+        ctx = get_script_run_ctx()
+        session_key = ctx.session_id if ctx else f"local_{os.getpid()}"
+        session_hash = hashlib.blake2b(session_key.encode(), digest_size=16).hexdigest()
         st.session_state.session_id = f"paird_chat_{session_hash}"
 
-    session_file = os.path.join(temp_dir, f"{st.session_state.session_id}.pkl")
+    session_file = os.path.join(temp_dir, f"{st.session_state.session_id}.msgpack")
     return session_file
 
+def evict_stale_session_files():
+    """Remove session files in the temp dir that haven't been touched in a day.
+
+    Also matches the .pkl suffix (orphans left behind by the old
+    pickle-based keying scheme) and .tmp (truncation scratch files
+    orphaned by a kill before their os.replace).
+    """
+    try:
+        temp_dir = tempfile.gettempdir()
+        cutoff = datetime.datetime.now().timestamp() - _SESSION_TTL_SECONDS
+        for name in os.listdir(temp_dir):
+            if name.startswith("paird_chat_") and name.endswith((".msgpack", ".pkl", ".tmp")):
+                path = os.path.join(temp_dir, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.unlink(path)
+                except OSError:
+                    pass
+        return True
+    except Exception:
+        return False
+
+def truncate_session_file(session_file):
+    """Trim an oversized session file down to its most recent frames"""
+    try:
+        with open(session_file, 'rb') as f:
+            data = memoryview(f.read())
+
+        frames = []
+        offset = 0
+        while offset + 4 <= len(data):
+            length = int.from_bytes(data[offset:offset + 4], 'big')
+            if offset + 4 + length > len(data):
+                break  # torn trailing frame; drop it rather than copy it through
+            frames.append(bytes(data[offset:offset + 4 + length]))
+            offset += 4 + length
+
+        # Write to a temp file and rename so a kill mid-rewrite can't
+        # leave a torn file behind
+        tmp_file = session_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(b''.join(frames[-_TRUNCATE_KEEP_FRAMES:]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, session_file)
+        return True
+    except Exception:
+        return False
+
+@st.cache_resource
+def _get_save_state():
+    """Start the background session writer once per process.
+
+    Saves are enqueued instead of written inline, so the UI doesn't block
+    on disk I/O after each assistant turn. The writer drains the queue,
+    coalescing deltas queued for the same file into one write. Deltas a
+    write failed to land are parked in 'errors' per file, so the next
+    save for that file can re-queue them and surface the error.
+    """
+    state = {'queue': queue.Queue(), 'errors': {}}
+
+    def _writer_loop():
+        save_queue = state['queue']
+        while True:
+            batch = [save_queue.get()]
+            try:
+                while True:
+                    batch.append(save_queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            pending = {}
+            for session_file, new_messages in batch:
+                pending.setdefault(session_file, []).extend(new_messages)
+
+            for session_file, new_messages in pending.items():
+                try:
+                    with open(session_file, 'ab') as f:
+                        f.write(b''.join(_encode_frame(m) for m in new_messages))
+
+                    # Keep the on-disk footprint bounded
+                    if os.path.getsize(session_file) > _MAX_SESSION_BYTES:
+                        truncate_session_file(session_file)
+                except Exception as e:
+                    # Park the failed delta for the next save to re-queue
+                    _, prior = state['errors'].get(session_file, (None, []))
+                    state['errors'][session_file] = (str(e), prior + new_messages)
+
+            for _ in batch:
+                save_queue.task_done()
+
+    threading.Thread(target=_writer_loop, daemon=True).start()
+    # Flush queued saves before the process exits
+    atexit.register(state['queue'].join)
+    return state
+
 def cleanup_session_data():
     """Clean up session data file"""
     try:
         session_file = get_session_file_path()
+        # Let in-flight writes land (and discard any parked failure)
+        # before deleting, so a queued delta for the old conversation
+        # can't be appended after the delete and resurface on restart
+        state = _get_save_state()
+        state['queue'].join()
+        state['errors'].pop(session_file, None)
         if os.path.exists(session_file):
             os.remove(session_file)
+        st.session_state._persisted_count = 0
+        # Opportunistically sweep other sessions' stale files too
+        evict_stale_session_files()
         return True
     except Exception:
         return False
@@ -65,13 +216,13 @@ def cleanup_session_data():
 col1, col2, col3 = st.columns([3, 1, 1])
 with col1:
     # Dynamic header based on selected model
-    st.header("GPT-Reed", divider="gray", anchor=False)
+    st.header(PAGE_TITLE, divider="gray", anchor=False)
 with col2:
     # Model selection
     selected_model = st.selectbox(
         " ",
-        options=list(AVAILABLE_MODELS.keys()),
-        index=list(AVAILABLE_MODELS.keys()).index(st.session_state.selected_model),
+        options=_MODEL_KEYS,
+        index=_MODEL_KEY_INDEX[st.session_state.selected_model],
         key="model_selector"
     )
 with col3:
@@ -94,24 +245,43 @@ with col3:
         st.rerun()
 
 
-def save_session_data():
-    """Save session data to temporary file"""
+def save_session_data(now=None):
+    """Queue messages not yet persisted for the background writer.
+
+    The file is an append-only log of length-prefixed msgpack frames
+    (4-byte big-endian length followed by one encoded message), so each
+    save only writes the new messages instead of re-serializing the
+    whole history every turn. Callers on the hot path can pass an
+    already-computed `now` to skip the extra clock read.
+    """
+    if now is None:
+        now = datetime.datetime.now()
     try:
-        if not st.session_state.get('messages'):
+        messages = st.session_state.get('messages')
+        if not messages:
             return True  # Nothing to save
 
         session_file = get_session_file_path()
-        session_data = {
-            'messages': st.session_state.messages,
-            'timestamp': datetime.datetime.now().isoformat(),
-            'session_id': st.session_state.session_id
-        }
+        state = _get_save_state()
 
-        with open(session_file, 'wb') as f:
-            pickle.dump(session_data, f)
+        # Pick up any delta a previous background write failed to land,
+        # so those messages get re-queued rather than silently dropped
+        failed_error, failed_messages = state['errors'].pop(session_file, (None, []))
+        if failed_error:
+            st.session_state.save_error = f"Save failed: {failed_error}"
+
+        persisted = st.session_state.get('_persisted_count', 0)
+        # The slice is a fresh list and message dicts are never mutated
+        # after append, so this snapshot is safe to hand to the writer
+        delta = failed_messages + messages[persisted:]
+        if not delta:
+            return True  # Already up to date
+
+        state['queue'].put((session_file, delta))
+        st.session_state._persisted_count = len(messages)
 
         # Debug info
-        st.session_state.last_save_time = datetime.datetime.now().strftime("%H:%M:%S")
+        st.session_state.last_save_time = now.strftime("%H:%M:%S")
         st.session_state.save_file_path = session_file
         return True
     except Exception as e:
@@ -119,26 +289,58 @@ def save_session_data():
         return False
 
 def load_session_data():
-    """Load session data from temporary file"""
+    """Load session messages by replaying the framed session file"""
     try:
         session_file = get_session_file_path()
 
         if os.path.exists(session_file):
+            # Read the whole file in one syscall and decode frames from a
+            # memoryview, instead of many small reads off the file handle
             with open(session_file, 'rb') as f:
-                session_data = pickle.load(f)
-
-            # Always load the messages if the file exists
-            if 'messages' in session_data and session_data['messages']:
-                return session_data['messages'], len(session_data['messages'])
+                data = memoryview(f.read())
+
+            # A kill mid-append can leave a partial frame at the end of the
+            # file; stop at the first incomplete frame instead of discarding
+            # the whole history
+            messages = []
+            offset = 0
+            while offset + 4 <= len(data):
+                length = int.from_bytes(data[offset:offset + 4], 'big')
+                if offset + 4 + length > len(data):
+                    break
+                messages.append(_DECODER.decode(_ZSTD_D.decompress(data[offset + 4:offset + 4 + length])))
+                offset += 4 + length
+
+            # Cut the torn tail off the file too, otherwise the writer
+            # appends new frames after the garbage bytes and the next
+            # restart misparses the log at the torn point
+            if offset < len(data):
+                os.truncate(session_file, offset)
+
+            if messages:
+                st.session_state._persisted_count = len(messages)
+                return messages, len(messages)
 
         return [], 0
     except Exception as e:
         st.session_state.load_error = f"Load failed: {str(e)}"
         return [], 0
 
+@st.cache_data
+def _system_prompt(date, model):
+    """Format the system prompt once per (date, model) instead of every send.
+
+    st.cache_data rather than lru_cache: reruns re-execute the script in a
+    fresh namespace, so a plain function-level cache would be rebuilt (and
+    thus empty) every turn.
+    """
+    return prompts.SYSTEM_PROMPT.format(current_date=date, model=model)
+
 # Helper functions for chat history
 def save_chat_history():
     """Save current chat history to a JSON file"""
+    import orjson  # only needed on the download path
+
     if st.session_state.messages:
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         chat_data = {
@@ -148,30 +350,38 @@ def save_chat_history():
             "total_messages": len(st.session_state.messages)
         }
 
-        # Create JSON string
-        json_string = json.dumps(chat_data, indent=2, ensure_ascii=False)
+        # Encode to JSON bytes (download_button accepts bytes directly,
+        # so no extra utf-8 encode is needed)
+        json_bytes = orjson.dumps(chat_data, option=orjson.OPT_INDENT_2)
 
         # Create download button in session state for later use
-        st.session_state.download_data = json_string
+        st.session_state.download_data = json_bytes
         st.session_state.download_filename = f"chat_history_{timestamp}.json"
         return True
     return False
 
 def load_chat_history(uploaded_file):
     """Load chat history from uploaded JSON file"""
+    import orjson  # only needed on the upload path
+
     try:
-        # Read the uploaded file
-        content = uploaded_file.read().decode('utf-8')
-        chat_data = json.loads(content)
+        # orjson parses bytes directly, no decode step needed
+        chat_data = orjson.loads(uploaded_file.read())
 
         # Validate the data structure
         if "messages" in chat_data and isinstance(chat_data["messages"], list):
+            # Replacing the message list invalidates the session file,
+            # which only ever holds messages[:_persisted_count]. Reset the
+            # on-disk state like the clear-chat path does, then persist
+            # the uploaded conversation from scratch.
+            cleanup_session_data()
             st.session_state.messages = chat_data["messages"]
+            save_session_data()
             st.session_state.conversation_loaded = True
             return True, f"✅ Loaded {len(chat_data['messages'])} messages from {chat_data.get('timestamp', 'Unknown date')}"
         else:
             return False, "❌ Invalid chat history file format"
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         return False, "❌ Invalid JSON file"
     except Exception as e:
         return False, f"❌ Error loading file: {str(e)}"
@@ -181,17 +391,20 @@ def export_chat_as_text():
     if st.session_state.messages:
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        text_content = f"Chat History Export\n"
-        text_content += f"Exported on: {timestamp}\n"
-        text_content += f"Model: {st.session_state.selected_model}\n"
-        text_content += f"Total Messages: {len(st.session_state.messages)}\n"
-        text_content += "=" * 50 + "\n\n"
+        # Collect parts and join once -- repeated str += is quadratic
+        parts = [
+            "Chat History Export\n",
+            f"Exported on: {timestamp}\n",
+            f"Model: {st.session_state.selected_model}\n",
+            f"Total Messages: {len(st.session_state.messages)}\n",
+            "=" * 50 + "\n\n",
+        ]
 
         for i, message in enumerate(st.session_state.messages, 1):
             role = "You" if message["role"] == "user" else "AI Assistant"
-            text_content += f"[{i}] {role}:\n{message['content']}\n\n"
+            parts.append(f"[{i}] {role}:\n{message['content']}\n\n")
 
-        return text_content
+        return ''.join(parts)
     return None
 
 
@@ -205,10 +418,18 @@ azure_api_key = os.getenv("AZURE_API_KEY")
 azure_endpoint = "https://reedc-mdrjnjlt-swedencentral.cognitiveservices.azure.com/"
 openai_api_key = os.getenv("OPENAI_API_KEY")
 
-if azure_api_key:
-    client = AzureOpenAI(api_key=azure_api_key, azure_endpoint=azure_endpoint, api_version=api_version)
-elif openai_api_key:
-    client = OpenAI(api_key=openai_api_key)
+
+@st.cache_resource
+def get_openai_client(endpoint, version):
+    """Build the API client once per process so its connection pool is reused
+    across reruns instead of being torn down on every widget event"""
+    if azure_api_key:
+        return AzureOpenAI(api_key=azure_api_key, azure_endpoint=endpoint, api_version=version)
+    return OpenAI(api_key=openai_api_key)
+
+
+if azure_api_key or openai_api_key:
+    client = get_openai_client(azure_endpoint, api_version)
 else:
     st.error("❌ **API key not found!** Please set the OPENAI_API_KEY or AZURE_API_KEY environment variable.")
     st.stop()
@@ -222,6 +443,9 @@ if "messages" not in st.session_state:
 if "session_initialized" not in st.session_state:
     st.session_state.session_initialized = True
 
+    # Sweep out session files left behind by dead sessions
+    evict_stale_session_files()
+
     # Try to load previous session data
     loaded_messages, message_count = load_session_data()
 
@@ -232,69 +456,74 @@ if "session_initialized" not in st.session_state:
     else:
         st.session_state.messages = []
 
-# Main chat container
-chat_container = st.container()
-
-# Display welcome message if no messages exist
-if not st.session_state.messages:
-    with chat_container:
-        st.markdown("""
+# Welcome banner HTML, materialized once per process rather than
+# re-allocated on every rerun
+@st.cache_resource
+def _get_welcome_html():
+    return """
         <div style="text-align: center; padding: 2rem; background-color: #f8fafc; border-radius: 15px; margin: 1rem 0;">
             <p style="color: #6b7280; font-size: 1.1rem;">
                 I'm here to help! This conversation is secure and private.
             </p>
         </div>
-        """, unsafe_allow_html=True)
-else:
+        """
+
+
+# Main chat area: render the welcome banner or the conversation so far.
+# This runs on every script rerun; a fragment wouldn't help because all of
+# this app's widgets live outside it, so every event is a full rerun anyway.
+def render_chat_history():
+    # Display welcome message if no messages exist
+    if not st.session_state.messages:
+        st.markdown(_get_welcome_html(), unsafe_allow_html=True)
+        return
+
     # Show conversation info if available
     if hasattr(st.session_state, 'conversation_loaded') and st.session_state.conversation_loaded:
         st.info("📁 **Conversation loaded from file** - Continue where you left off!")
         # Reset the flag so it doesn't show again
         st.session_state.conversation_loaded = False
 
-
-# Display the existing chat messages with improved styling
-with chat_container:
-    for i, message in enumerate(st.session_state.messages):
+    # Display the existing chat messages with improved styling
+    for message in st.session_state.messages:
         if message["role"] == "user":
-            with st.chat_message("user", avatar=":material/account_circle:"):
+            with st.chat_message("user", avatar=USER_AVATAR):
                 st.markdown(f"{message['content']}")
         else:
-            with st.chat_message("assistant", avatar=":material/auto_awesome:"):
+            with st.chat_message("assistant", avatar=ASSISTANT_AVATAR):
                 st.markdown(message["content"])
 
+
+render_chat_history()
+
 # Create a chat input field to allow the user to enter a message. This will display
 # automatically at the bottom of the page.
 if prompt := st.chat_input("Ask anything", key="chat_input"):
 
-    # Store and display the current prompt.
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    # One clock read per turn; everything below reuses it
+    _now = datetime.datetime.now()
 
-    # Save session data after user input
-    save_session_data()
+    # Store and display the current prompt. No save yet -- the save after the
+    # assistant turn (or its error path) persists both new messages at once.
+    st.session_state.messages.append({"role": "user", "content": prompt})
 
     # Display user message
-    with st.chat_message("user", avatar=":material/account_circle:"):
+    with st.chat_message("user", avatar=USER_AVATAR):
         st.markdown(f"{prompt}")
 
     # Generate and display assistant response
-    with st.chat_message("assistant", avatar=":material/auto_awesome:"):
+    with st.chat_message("assistant", avatar=ASSISTANT_AVATAR):
         with st.spinner("Thinking..."):
             try:
                 # Generate a response using the OpenAI API.
+                # Session messages are already {"role", "content"} dicts, so
+                # pass them as-is instead of rebuilding a copy of each one
                 stream = client.chat.completions.create(
                     model=model,
                     messages=[
-                        {"role": "system", "content": prompts.SYSTEM_PROMPT.format(
-                                current_date=datetime.datetime.now().strftime("%Y-%m-%d"),
-                                model=model
-
-                            )
-                        },
-                        *[
-                            {"role": m["role"], "content": m["content"]}
-                            for m in st.session_state.messages
-                        ]
+                        {"role": "system", "content": _system_prompt(
+                            _now.strftime("%Y-%m-%d"), model)},
+                        *st.session_state.messages,
                     ],
                     stream=True,
                 )
@@ -305,7 +534,7 @@ if prompt := st.chat_input("Ask anything", key="chat_input"):
                 st.session_state.messages.append({"role": "assistant", "content": response})
 
                 # Save session data after each interaction
-                save_session_data()
+                save_session_data(now=_now)
 
             except Exception as e:
                 error_message = f"❌ **Error generating response:** {str(e)}"
@@ -313,7 +542,7 @@ if prompt := st.chat_input("Ask anything", key="chat_input"):
                 st.session_state.messages.append({"role": "assistant", "content": error_message})
 
                 # Save session data even after errors
-                save_session_data()
+                save_session_data(now=_now)
 
 # Add keyboard shortcut for clear chat button (at the very end)
 add_shortcuts(